@@ -2,7 +2,11 @@ from flask import Flask, render_template, request, redirect, url_for, flash, ses
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
-from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import os
+import time
+from functools import wraps, lru_cache
 from datetime import datetime  # <-- This import is needed for orders
 
 app = Flask(__name__)
@@ -11,6 +15,22 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_super_secret_key_12345'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Debug mode: on by default for `python app.py`, FLASK_DEBUG=1 for `flask run`.
+# Read here because the models below depend on it at import time.
+DEBUG = os.environ.get('FLASK_DEBUG', '1' if __name__ == '__main__' else '0') == '1'
+# Connection pool sizing for a server database. SQLite keeps SQLAlchemy's
+# defaults, since extra file connections would only queue on its write lock.
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': False
+    }
+# bcrypt cost factor (2^rounds iterations). Each step down halves hashing time on
+# register/login; the default is 12. Existing hashes keep their own cost and
+# still verify, so this can be raised again later without a migration.
+app.config['BCRYPT_LOG_ROUNDS'] = 10
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
@@ -18,6 +38,23 @@ login_manager.login_view = 'login'  # <-- Tells @login_required where to send us
 login_manager.login_message_category = 'info'
 
 
+# --- SQLite Tuning ---
+# WAL lets readers run alongside a writer, and synchronous=NORMAL only fsyncs at
+# checkpoints instead of on every commit.
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+
 # --- Models (Database Tables) ---
 
 class User(db.Model, UserMixin):
@@ -29,7 +66,9 @@ class User(db.Model, UserMixin):
 
     # --- NEW ADMIN FIELDS ---
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
-    orders = db.relationship('Order', backref='user', lazy=True)
+    # dynamic: user.orders is a query, so counts/slices don't load every order.
+    # (Order.order_items stays a plain list so admin_sales can selectinload it.)
+    orders = db.relationship('Order', backref='user', lazy='dynamic')
 
 
 class Bike(db.Model):
@@ -45,7 +84,12 @@ class CartItem(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     bike_id = db.Column(db.Integer, db.ForeignKey('bike.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=1)
-    bike = db.relationship('Bike')
+    # In debug mode an unplanned lazy load raises, so N+1 queries show up early;
+    # routes that need the bike ask for it with joinedload(CartItem.bike).
+    bike = db.relationship('Bike', lazy='raise' if DEBUG else 'select')
+
+    # One row per (user, bike); also makes the add_to_cart lookup a single index probe
+    __table_args__ = (db.Index('ix_cart_user_bike', 'user_id', 'bike_id', unique=True),)
 
 
 # --- NEW ORDER MODELS ---
@@ -68,7 +112,8 @@ class OrderItem(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Called once per request; current_user is then reused by admin_required
+    return db.session.get(User, int(user_id))
 
 
 # --- NEW ADMIN DECORATOR ---
@@ -116,6 +161,70 @@ def create_initial_products():
         print("Created 5 initial products.")
 
 
+# --- Database Setup (run once per deployment: `flask --app app init-db`) ---
+# Re-run init-db after upgrading an existing database: create_all() only adds
+# missing tables, so indexes added to existing tables are created here.
+def merge_duplicate_cart_items():
+    # ix_cart_user_bike is unique, so fold repeated (user, bike) rows into one first
+    duplicates = db.session.query(
+        CartItem.user_id, CartItem.bike_id, db.func.min(CartItem.id), db.func.sum(CartItem.quantity)
+    ).group_by(CartItem.user_id, CartItem.bike_id).having(db.func.count() > 1).all()
+    for user_id, bike_id, keep_id, quantity in duplicates:
+        CartItem.query.filter_by(id=keep_id).update({'quantity': quantity})
+        CartItem.query.filter(
+            CartItem.user_id == user_id, CartItem.bike_id == bike_id, CartItem.id != keep_id
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def init_db():
+    db.create_all()
+    merge_duplicate_cart_items()
+    for index in CartItem.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    create_initial_products()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database tables and seed the initial products."""
+    init_db()
+    print("Initialized the database.")
+
+
+# --- Cached Bike Catalog ---
+# The catalog rarely changes, so each process keeps a read-only copy for up to
+# BIKE_CATALOG_TTL seconds. Writes from another process (e.g. `init-db`) show up
+# once the copy expires. Plain rows (not ORM objects) are cached, so nothing is
+# tied to a session.
+BIKE_CATALOG_TTL = 60
+
+
+@lru_cache(maxsize=1)
+def _load_bike_catalog(time_bucket):
+    return tuple(db.session.execute(
+        db.select(Bike.id, Bike.name, Bike.price, Bike.description, Bike.image_url)
+    ).all())
+
+
+def bike_catalog():
+    return _load_bike_catalog(int(time.time() // BIKE_CATALOG_TTL))
+
+
+# --- Helper Function to Count Cart Items ---
+def count_cart_items(user_id):
+    return db.session.query(db.func.sum(CartItem.quantity)).filter_by(user_id=user_id).scalar() or 0
+
+
+def adjust_cart_size(delta):
+    # Call after committing a cart change. If the session has no count yet
+    # (e.g. logged back in by the remember-me cookie), reload it from the DB.
+    if 'cart_size' in session:
+        session['cart_size'] = max(session['cart_size'] + delta, 0)
+    else:
+        session['cart_size'] = count_cart_items(current_user.id)
+
+
 # --- Context Processor (Global Variables for Templates) ---
 @app.context_processor
 def inject_global_vars():
@@ -123,7 +232,11 @@ def inject_global_vars():
     username = None
     if current_user.is_authenticated:
         username = current_user.username
-        cart_size = db.session.query(db.func.sum(CartItem.quantity)).filter_by(user_id=current_user.id).scalar() or 0
+        # The count lives in the session and is kept up to date by the cart
+        # routes, so only the first request after login has to query it.
+        if 'cart_size' not in session:
+            session['cart_size'] = count_cart_items(current_user.id)
+        cart_size = session['cart_size']
     return dict(cart_size=cart_size, username=username)
 
 
@@ -137,7 +250,7 @@ def index():
 @app.route('/products')
 @login_required  # This page is now protected
 def products():
-    all_bikes = Bike.query.all()
+    all_bikes = bike_catalog()
     return render_template('products.html', bikes=all_bikes)
 
 
@@ -157,11 +270,15 @@ def register():
         email = request.form.get('email')
         password = request.form.get('password')
 
-        if User.query.filter_by(username=username).first():
-            flash('Username already exists.', 'danger')
-            return redirect(url_for('register'))
-        if User.query.filter_by(email=email).first():
-            flash('Email already registered.', 'danger')
+        # One query checks both unique fields
+        existing = db.session.query(User.username, User.email).filter(
+            db.or_(User.username == username, User.email == email)
+        ).first()
+        if existing:
+            if existing.username == username:
+                flash('Username already exists.', 'danger')
+            else:
+                flash('Email already registered.', 'danger')
             return redirect(url_for('register'))
 
         hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
@@ -183,6 +300,7 @@ def login():
         user = User.query.filter_by(email=email).first()
         if user and bcrypt.check_password_hash(user.password, password):
             login_user(user, remember=True)
+            session['cart_size'] = count_cart_items(user.id)
 
             # Send user to the shop after login
             return redirect(url_for('products'))
@@ -195,6 +313,7 @@ def login():
 @login_required
 def logout():
     logout_user()
+    session.pop('cart_size', None)
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))  # Send to login page after logout
 
@@ -203,15 +322,15 @@ def logout():
 @app.route('/add_to_cart/<int:bike_id>', methods=['POST'])
 @login_required
 def add_to_cart(bike_id):
-    cart_item = CartItem.query.filter_by(user_id=current_user.id, bike_id=bike_id).first()
-
-    if cart_item:
-        cart_item.quantity += 1
-    else:
-        cart_item = CartItem(user_id=current_user.id, bike_id=bike_id, quantity=1)
-        db.session.add(cart_item)
-
+    # Insert the line, or bump its quantity if it already exists (relies on ix_cart_user_bike)
+    stmt = sqlite_insert(CartItem).values(user_id=current_user.id, bike_id=bike_id, quantity=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'bike_id'],
+        set_={'quantity': CartItem.__table__.c.quantity + 1}
+    )
+    db.session.execute(stmt)
     db.session.commit()
+    adjust_cart_size(1)
     flash('Item added to cart!', 'success')
     return redirect(url_for('products'))
 
@@ -219,20 +338,26 @@ def add_to_cart(bike_id):
 @app.route('/cart')
 @login_required
 def view_cart():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-    total = 0
-    for item in cart_items:
-        total += item.bike.price * item.quantity
+    # Read-only page: select just the columns the template shows, joined with
+    # bike in one query, as plain rows instead of ORM objects.
+    cart_items = db.session.execute(
+        db.select(CartItem.id, CartItem.quantity, Bike.name, Bike.price, Bike.image_url)
+        .join(CartItem.bike)
+        .where(CartItem.user_id == current_user.id)
+    ).all()
+    total = sum(item.price * item.quantity for item in cart_items)
     return render_template('cart.html', cart_items=cart_items, total=total)
 
 
 @app.route('/remove_from_cart/<int:item_id>', methods=['POST'])
 @login_required
 def remove_from_cart(item_id):
-    cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user.id).first()
-    if cart_item:
+    # Primary-key get can be served from the identity map; ownership is checked after
+    cart_item = db.session.get(CartItem, item_id)
+    if cart_item and cart_item.user_id == current_user.id:
         db.session.delete(cart_item)
         db.session.commit()
+        adjust_cart_size(-cart_item.quantity)
         flash('Item removed from cart.', 'success')
     return redirect(url_for('view_cart'))
 
@@ -243,19 +368,25 @@ def update_cart(item_id):
     new_quantity = request.form.get(f'quantity')
     if new_quantity:
         new_quantity = int(new_quantity)
-        cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user.id).first()
-        if cart_item:
+        cart_item = db.session.get(CartItem, item_id)
+        if cart_item and cart_item.user_id == current_user.id:
+            old_quantity = cart_item.quantity
             if new_quantity <= 0:
                 db.session.delete(cart_item)
+                new_quantity = 0
                 flash('Item removed from cart.', 'success')
             else:
                 cart_item.quantity = new_quantity
                 flash('Cart updated.', 'success')
             db.session.commit()
+            adjust_cart_size(new_quantity - old_quantity)
     return redirect(url_for('view_cart'))
 
 
 # --- Checkout Route ---
+
+TAX_RATE = 0.05  # Shown to customers as "Taxes (5%)"
+
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
@@ -266,7 +397,7 @@ def checkout():
         return redirect(url_for('view_cart'))
 
     total = sum(item.bike.price * item.quantity for item in cart_items)
-    tax = total * 0.05
+    tax = total * TAX_RATE
     grand_total = total + tax
 
     if request.method == 'POST':
@@ -279,23 +410,24 @@ def checkout():
         # 1. Create the main Order
         new_order = Order(user_id=current_user.id, total_price=grand_total)
         db.session.add(new_order)
-        db.session.commit()  # Commit to get new_order.id
-
-        # 2. Create OrderItems for each item in cart
-        for item in cart_items:
-            order_item = OrderItem(
-                order_id=new_order.id,
-                bike_name=item.bike.name,
-                price=item.bike.price,
-                quantity=item.quantity
-            )
-            db.session.add(order_item)
-
-        # 3. Clear the cart
-        for item in cart_items:
-            db.session.delete(item)
+        db.session.flush()  # Flush to get new_order.id without ending the transaction
+
+        # 2. Create OrderItems for each item in cart (one multi-row INSERT)
+        db.session.execute(OrderItem.__table__.insert(), [
+            {
+                'order_id': new_order.id,
+                'bike_name': item.bike.name,
+                'price': item.bike.price,
+                'quantity': item.quantity
+            }
+            for item in cart_items
+        ])
+
+        # 3. Clear the cart (one DELETE)
+        CartItem.query.filter(CartItem.id.in_([item.id for item in cart_items])).delete(synchronize_session=False)
 
         db.session.commit()  # Commit all changes
+        session['cart_size'] = 0
 
         flash('Payment successful! Thank you for your order.', 'success')
         return redirect(url_for('products'))
@@ -305,6 +437,8 @@ def checkout():
 
 # --- NEW ADMIN ROUTES ---
 
+ADMIN_SALES_LIMIT = 100  # Most recent orders shown on the sales page
+
 @app.route('/admin')
 @login_required
 @admin_required
@@ -316,7 +450,8 @@ def admin_dashboard():
 @login_required
 @admin_required
 def admin_users():
-    users = User.query.all()
+    # Only the columns the table shows (skips the password hash and ORM objects)
+    users = db.session.query(User.id, User.username, User.email, User.is_admin).all()
     return render_template('admin_users.html', users=users)
 
 
@@ -325,18 +460,20 @@ def admin_users():
 @admin_required
 def admin_sales():
     # Load orders, and eager-load the 'user' and 'order_items' relationships
-    # to prevent N+1 queries in the template.
+    # to prevent N+1 queries in the template. order_items is one-to-many, so it
+    # uses a second SELECT ... IN (...) rather than a JOIN that repeats each order row.
     orders = Order.query.options(
         db.joinedload(Order.user),
-        db.joinedload(Order.order_items)
-    ).order_by(Order.order_date.desc()).all()
+        db.selectinload(Order.order_items)
+    ).order_by(Order.order_date.desc()).limit(ADMIN_SALES_LIMIT).all()
 
     return render_template('admin_sales.html', orders=orders)
 
 
 # --- Main Driver ---
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        create_initial_products()
-    app.run(debug=True)
\ No newline at end of file
+    # Set INIT_DB=1 to create tables/seed data before starting the dev server
+    if os.environ.get('INIT_DB') == '1':
+        with app.app_context():
+            init_db()
+    app.run(debug=DEBUG)
\ No newline at end of file